@@ -3,17 +3,23 @@ MedASR Backend Server
 FastAPI server for medical speech-to-text transcription
 """
 
+import asyncio
+import contextlib
 import os
-import tempfile
+import sys
 import logging
+import tempfile
 from pathlib import Path
+from typing import BinaryIO, List, Optional, Set, Tuple, Union
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import av
+import numpy as np
+import soundfile as sf
+from fastapi import FastAPI, File, UploadFile, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from pydub import AudioSegment
 
-from transcribe import get_transcriber, transcribe_audio
+from transcribe import get_transcriber
 
 # Configure logging
 logging.basicConfig(
@@ -38,44 +44,238 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Number of transcriptions allowed on the GPU at once
+GPU_SEM = asyncio.Semaphore(int(os.getenv("MEDASR_GPU_SLOTS", "1")))
+
+# Micro-batching: requests queued while the GPU is busy, or arriving within
+# MAX_WAIT_MS of each other, share one forward pass of up to MAX_BATCH clips
+MAX_BATCH = int(os.getenv("MEDASR_MAX_BATCH", "8"))
+MAX_WAIT_MS = int(os.getenv("MEDASR_BATCH_WAIT_MS", "10"))
+
+# Clips are only batched with others at most BATCH_LENGTH_RATIO times their
+# length, so one long clip doesn't pad a whole batch to its size
+BATCH_LENGTH_RATIO = 2.0
+
+# /transcribe clips longer than this go through the chunked path instead of
+# the batcher, bounding per-batch padding and memory
+MAX_CLIP_S = float(os.getenv("MEDASR_MAX_CLIP_S", "30"))
+
+# Streaming: a partial hypothesis is sent after every STREAM_STEP_S of new
+# audio, decoding at most the last STREAM_WINDOW_S before committing it
+STREAM_STEP_S = float(os.getenv("MEDASR_STREAM_STEP_S", "0.32"))
+STREAM_WINDOW_S = float(os.getenv("MEDASR_STREAM_WINDOW_S", "20"))
+
+# Number of GPUs to spread uvicorn workers over (one GPU per worker)
+NUM_GPUS = int(os.getenv("MEDASR_NUM_GPUS", "1"))
+
 # Supported audio formats
 SUPPORTED_FORMATS = {".wav", ".m4a", ".mp3", ".mp4", ".aac", ".ogg", ".flac"}
 
+# Formats libsndfile decodes natively; everything else goes through PyAV (ffmpeg)
+SOUNDFILE_FORMATS = {".wav", ".flac", ".ogg"}
 
-def convert_to_wav(input_path: str, output_path: str) -> str:
+
+def decode_audio(source: BinaryIO, file_ext: str) -> Tuple[np.ndarray, int]:
     """
-    Convert audio file to WAV format at 16kHz mono.
+    Decode audio from a file object to a mono float32 array at its native
+    sample rate, without writing anything to disk.
 
     Args:
-        input_path: Path to input audio file
-        output_path: Path for output WAV file
+        source: Readable, seekable file object with the encoded audio
+        file_ext: Extension of the original file, used to pick the decoder
 
     Returns:
-        Path to the converted WAV file
+        Tuple of (samples, sample_rate)
     """
-    logger.info(f"Converting {input_path} to WAV format")
+    logger.info(f"Decoding {file_ext} audio")
+
+    if file_ext in SOUNDFILE_FORMATS:
+        # soundfile returns (frames,) or (frames, channels)
+        audio, sr = sf.read(source, dtype="float32", always_2d=False)
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+    else:
+        # PyAV decodes in-process with its bundled ffmpeg; the resampler
+        # downmixes to packed mono float32 at the stream's own rate
+        with av.open(source) as container:
+            stream = container.streams.audio[0]
+            sr = stream.codec_context.sample_rate
+            resampler = av.AudioResampler(format="flt", layout="mono", rate=sr)
+
+            frames = []
+            for frame in container.decode(stream):
+                frames.extend(resampler.resample(frame))
+            frames.extend(resampler.resample(None))
+
+        audio = (
+            np.concatenate([f.to_ndarray().reshape(-1) for f in frames])
+            if frames else np.zeros(0, dtype=np.float32)
+        )
+
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    logger.info(f"Decoded {len(audio)} samples at {sr}Hz")
+    return audio, sr
+
 
-    # Load audio with pydub
-    audio = AudioSegment.from_file(input_path)
+# Lock file held for the worker's lifetime to reserve its GPU slot
+_gpu_slot_file = None
 
-    # Convert to mono and set sample rate to 16kHz
-    audio = audio.set_channels(1)
-    audio = audio.set_frame_rate(16000)
 
-    # Export as WAV
-    audio.export(output_path, format="wav")
+def _try_lock(f) -> bool:
+    """Take a non-blocking exclusive lock on an open file."""
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def bind_gpu():
+    """
+    Pin this worker process to one GPU when MEDASR_NUM_GPUS > 1.
 
-    logger.info(f"Converted to: {output_path}")
-    return output_path
+    Each worker claims the lowest free slot by locking a file in the temp
+    directory, so workers spread round-robin across GPUs. The OS releases
+    the lock when a worker exits. Must run in the worker before CUDA is
+    initialized; an explicit CUDA_VISIBLE_DEVICES is left alone.
+    """
+    global _gpu_slot_file
+
+    if NUM_GPUS <= 1:
+        return
+    if "CUDA_VISIBLE_DEVICES" in os.environ:
+        logger.info(f"Using CUDA_VISIBLE_DEVICES={os.environ['CUDA_VISIBLE_DEVICES']}")
+        return
+
+    for slot in range(NUM_GPUS * 16):
+        path = os.path.join(tempfile.gettempdir(), f"medasr-worker-{slot}.lock")
+        try:
+            f = open(path, "a+")
+        except OSError as e:
+            # e.g. a lock file owned by another user; try the next slot
+            logger.debug(f"Skipping GPU slot {slot}: {str(e)}")
+            continue
+        if _try_lock(f):
+            _gpu_slot_file = f
+            gpu = slot % NUM_GPUS
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
+            logger.info(f"Worker {os.getpid()} took slot {slot}, bound to GPU {gpu}")
+            return
+        f.close()
+
+    logger.warning("No free worker slot; using all visible GPUs")
+
+
+class TranscriptionBatcher:
+    """Coalesces concurrent transcription requests into batched forward passes."""
+
+    def __init__(self, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self):
+        """Start the background task that drains the queue. Call from the event loop."""
+        self._queue = asyncio.Queue()
+        self._spawn(self._run())
+
+    async def submit(self, audio: np.ndarray, use_cache: bool = True) -> str:
+        """
+        Queue 16kHz audio for transcription and wait for its text.
+
+        Args:
+            audio: 16kHz float32 samples, as returned by prepare_audio
+            use_cache: Whether to store the result in the cache
+
+        Returns:
+            Transcribed text
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((audio, use_cache, future))
+        return await future
+
+    def _spawn(self, coro):
+        # Keep a reference so running tasks aren't garbage collected
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+
+            # Wait for a free GPU slot before closing the batch, so requests
+            # arriving during the previous forward pass join this one
+            await GPU_SEM.acquire()
+            try:
+                # Give concurrent requests a short window to join this batch
+                if self._queue.qsize() < self.max_batch - 1:
+                    await asyncio.sleep(self.max_wait)
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                # Run in the background; _process releases the slot when done
+                self._spawn(self._process(batch))
+            except BaseException:
+                GPU_SEM.release()
+                raise
+
+    @staticmethod
+    def _group_by_length(batch: list) -> List[list]:
+        """Split a batch into groups of clips with similar lengths."""
+        groups = []
+        for item in sorted(batch, key=lambda item: len(item[0])):
+            if groups and len(item[0]) <= BATCH_LENGTH_RATIO * len(groups[-1][0][0]):
+                groups[-1].append(item)
+            else:
+                groups.append([item])
+        return groups
+
+    async def _process(self, batch: List[Tuple[np.ndarray, bool, asyncio.Future]]):
+        """Transcribe a batch while holding a GPU_SEM slot acquired by _run."""
+        try:
+            # Skip requests whose clients have already gone away
+            batch = [item for item in batch if not item[2].done()]
+
+            for group in self._group_by_length(batch):
+                try:
+                    texts = await asyncio.to_thread(
+                        get_transcriber().transcribe_batch,
+                        [audio for audio, _, _ in group],
+                        [use_cache for _, use_cache, _ in group],
+                    )
+                except Exception as e:
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, _, future), text in zip(group, texts):
+                        if not future.done():
+                            future.set_result(text)
+        finally:
+            GPU_SEM.release()
+
+
+batcher = TranscriptionBatcher()
 
 
 @app.on_event("startup")
 async def startup_event():
     """Pre-load the model on server startup."""
     logger.info("Starting MedASR server...")
-    # Optionally pre-load model (uncomment to load at startup)
-    # This increases startup time but reduces first request latency
-    # get_transcriber().load_model()
+    # Runs in each worker process, before anything touches CUDA
+    bind_gpu()
+    # Load and warm up the model before accepting traffic so the first
+    # request doesn't pay for loading and kernel selection. Runs in a worker
+    # thread to keep the event loop free.
+    await asyncio.to_thread(get_transcriber().warmup)
+    batcher.start()
     logger.info("Server started successfully")
 
 
@@ -120,32 +320,30 @@ async def transcribe_endpoint(file: UploadFile = File(...)):
     logger.info(f"Received file: {file.filename} ({file.content_type})")
 
     try:
-        # Create temp directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Save uploaded file
-            input_path = os.path.join(temp_dir, f"input{file_ext}")
-            with open(input_path, "wb") as f:
-                content = await file.read()
-                f.write(content)
-
-            logger.info(f"Saved upload to: {input_path} ({len(content)} bytes)")
-
-            # Convert to WAV if needed
-            if file_ext != ".wav":
-                wav_path = os.path.join(temp_dir, "audio.wav")
-                convert_to_wav(input_path, wav_path)
-                audio_path = wav_path
-            else:
-                audio_path = input_path
-
-            # Transcribe
-            text = transcribe_audio(audio_path)
-
-            return JSONResponse(content={
-                "success": True,
-                "text": text,
-                "filename": file.filename
-            })
+        logger.info(f"Upload size: {file.size} bytes")
+
+        # Decode straight from the upload buffer to a numpy array
+        audio, sr = await asyncio.to_thread(decode_audio, file.file, file_ext)
+
+        # Resample and validate, then serve from the cache or transcribe
+        # alongside any concurrent requests. Long clips are chunked on their
+        # own rather than padding a shared batch.
+        transcriber = get_transcriber()
+        audio = await asyncio.to_thread(transcriber.prepare_audio, audio, sr)
+        cached = await asyncio.to_thread(transcriber.lookup_cache, audio)
+        if cached is not None:
+            text = cached
+        elif len(audio) > MAX_CLIP_S * 16000:
+            async with GPU_SEM:
+                text = await asyncio.to_thread(transcriber.transcribe_chunks, audio, 16000)
+        else:
+            text = await batcher.submit(audio)
+
+        return JSONResponse(content={
+            "success": True,
+            "text": text,
+            "filename": file.filename
+        })
 
     except Exception as e:
         logger.error(f"Transcription error: {str(e)}", exc_info=True)
@@ -181,30 +379,19 @@ async def transcribe_long_endpoint(file: UploadFile = File(...)):
     logger.info(f"Received long audio file: {file.filename}")
 
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Save uploaded file
-            input_path = os.path.join(temp_dir, f"input{file_ext}")
-            with open(input_path, "wb") as f:
-                content = await file.read()
-                f.write(content)
-
-            # Convert to WAV if needed
-            if file_ext != ".wav":
-                wav_path = os.path.join(temp_dir, "audio.wav")
-                convert_to_wav(input_path, wav_path)
-                audio_path = wav_path
-            else:
-                audio_path = input_path
+        # Decode straight from the upload buffer to a numpy array
+        audio, sr = await asyncio.to_thread(decode_audio, file.file, file_ext)
 
-            # Transcribe with chunking
-            transcriber = get_transcriber()
-            text = transcriber.transcribe_chunks(audio_path)
+        # Transcribe with chunking, off the event loop
+        transcriber = get_transcriber()
+        async with GPU_SEM:
+            text = await asyncio.to_thread(transcriber.transcribe_chunks, audio, sr)
 
-            return JSONResponse(content={
-                "success": True,
-                "text": text,
-                "filename": file.filename
-            })
+        return JSONResponse(content={
+            "success": True,
+            "text": text,
+            "filename": file.filename
+        })
 
     except Exception as e:
         logger.error(f"Long transcription error: {str(e)}", exc_info=True)
@@ -214,6 +401,137 @@ async def transcribe_long_endpoint(file: UploadFile = File(...)):
         )
 
 
+@app.websocket("/ws/transcribe")
+async def transcribe_stream(websocket: WebSocket):
+    """
+    Stream audio for real-time transcription.
+
+    The client sends binary messages of 16kHz mono little-endian int16 PCM
+    (e.g. 200 ms frames) and a text message "end" when done. The server
+    replies with {"partial": text} as audio arrives and a single
+    {"final": text} once the remaining audio is decoded. A failed partial
+    pass is reported as {"error": message} and the stream continues.
+    """
+    await websocket.accept()
+    logger.info("Streaming session started")
+
+    transcriber = get_transcriber()
+    step_samples = int(STREAM_STEP_S * 16000)
+    window_samples = int(STREAM_WINDOW_S * 16000)
+
+    # Committed windows: their text once decoded, or their audio if that
+    # pass hasn't finished (or failed) and must be redone for the final text
+    segments: List[Union[str, np.ndarray]] = []
+    window: List[np.ndarray] = []  # Float frames since the last commit
+    window_len = 0
+    since_partial = 0
+    partial_task: Optional[asyncio.Task] = None
+    partial_commits = False  # Whether partial_task is decoding a committed window
+
+    async def decode(audio: np.ndarray) -> str:
+        try:
+            audio = await asyncio.to_thread(transcriber.prepare_audio, audio, 16000, logging.DEBUG)
+        except ValueError:
+            # Too short or silent
+            return ""
+        # Streaming windows are never repeated, so keep them out of the cache
+        return await batcher.submit(audio, use_cache=False)
+
+    async def send_partial(audio: np.ndarray, segment: Optional[int]):
+        try:
+            text = await decode(audio)
+            if segment is not None:
+                segments[segment] = text
+                text = ""
+
+            committed = [seg for seg in segments if isinstance(seg, str) and seg]
+            await websocket.send_json({"partial": " ".join(committed + ([text] if text else []))})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Streaming partial error: {str(e)}", exc_info=True)
+            try:
+                await websocket.send_json({"error": f"Partial transcription failed: {str(e)}"})
+            except Exception:
+                # Client already gone; the receive loop will see the disconnect
+                pass
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("text") == "end":
+                break
+            if not message.get("bytes"):
+                continue
+
+            pcm = np.frombuffer(message["bytes"], dtype="<i2")
+            window.append(pcm.astype(np.float32) / 32768)
+            window_len += len(pcm)
+            since_partial += len(pcm)
+
+            # Decode the current window in the background, one pass at a
+            # time per connection; a full window is committed and restarted
+            if since_partial >= step_samples and (partial_task is None or partial_task.done()):
+                audio = np.concatenate(window)
+                segment = None
+                if window_len >= window_samples:
+                    segments.append(audio)
+                    segment = len(segments) - 1
+                    window, window_len = [], 0
+                since_partial = 0
+                partial_task = asyncio.create_task(send_partial(audio, segment))
+                partial_commits = segment is not None
+
+        # Let an in-flight pass over a committed window finish rather than
+        # redo its work; a pass over the uncommitted window is superseded by
+        # the tail decode below
+        if partial_task is not None:
+            if partial_commits:
+                await partial_task
+            else:
+                partial_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await partial_task
+
+        # Final text: committed windows plus the remaining tail; only windows
+        # without a decoded transcript go back through the model
+        if window:
+            segments.append(np.concatenate(window))
+        texts = await asyncio.gather(*(
+            decode(seg) if isinstance(seg, np.ndarray) else asyncio.sleep(0, result=seg)
+            for seg in segments
+        ))
+        text = " ".join(t for t in texts if t)
+
+        await websocket.send_json({"final": text})
+        await websocket.close()
+        logger.info(f"Streaming session complete: {len(segments)} segment(s), {len(text)} characters")
+
+    except WebSocketDisconnect:
+        logger.info("Streaming client disconnected")
+
+    except Exception as e:
+        logger.error(f"Streaming transcription error: {str(e)}", exc_info=True)
+        await websocket.send_json({"error": f"Transcription failed: {str(e)}"})
+        await websocket.close(code=1011)
+
+    finally:
+        if partial_task is not None and not partial_task.done():
+            partial_task.cancel()
+
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # uvloop isn't available on Windows; fall back to the asyncio loop there
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WORKERS", "1")),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        log_level="info",
+    )
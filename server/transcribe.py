@@ -3,21 +3,114 @@ MedASR Model Wrapper for Medical Speech-to-Text Transcription
 Uses Google's MedASR model from Hugging Face
 """
 
+import contextlib
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
 import torch
-import librosa
 import numpy as np
+import soxr
 from transformers import AutoModelForCTC, AutoProcessor
-from typing import Optional
+from typing import List, Optional
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Stage CUDA inputs through pinned host buffers (MEDASR_PIN_MEMORY=1). Off by
+# default: with one GPU slot the forward pass needs the data as soon as the
+# copy is queued, so there is little to overlap. Inputs larger than
+# PIN_MAX_BYTES use a plain copy so the pinned pool stays bounded.
+PIN_MEMORY = os.getenv("MEDASR_PIN_MEMORY") == "1"
+PIN_MAX_BYTES = int(os.getenv("MEDASR_PIN_MAX_MB", "64")) << 20
+
+# Patterns for cleaning decoded text
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
+
+# Optional transcription cache. Off unless MEDASR_CACHE_DB names an SQLite
+# file; note it stores transcript text unencrypted.
+CACHE_PATH = os.getenv("MEDASR_CACHE_DB", "")
+CACHE_MAX_ROWS = int(os.getenv("MEDASR_CACHE_MAX_ROWS", "10000"))
+CACHE_TTL_S = float(os.getenv("MEDASR_CACHE_TTL_S", str(24 * 3600)))
+
+
+class TranscriptionCache:
+    """
+    SQLite-backed store of transcriptions keyed by a hash of the audio.
+
+    Entries expire after ttl_s seconds and only the newest max_rows are kept.
+    Database errors (e.g. a locked file shared between workers) are logged
+    and treated as misses, so the cache can never fail a transcription.
+    """
+
+    def __init__(self, path: str, max_rows: int = CACHE_MAX_ROWS, ttl_s: float = CACHE_TTL_S):
+        self.max_rows = max_rows
+        self.ttl_s = ttl_s
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS transcripts(h BLOB PRIMARY KEY, text TEXT, created REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS transcripts_created ON transcripts(created)")
+            self._conn.commit()
+
+    @staticmethod
+    def key(audio: np.ndarray, config: str) -> bytes:
+        """Hash 16kHz samples together with the model configuration that transcribes them."""
+        h = hashlib.blake2b(config.encode(), digest_size=16)
+        h.update(np.ascontiguousarray(audio))
+        return h.digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        """Return the cached text, or None on a miss or a database error."""
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT text FROM transcripts WHERE h=? AND created>=?",
+                    (key, time.time() - self.ttl_s),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Cache lookup failed: {str(e)}")
+            return None
+        return row[0] if row else None
+
+    def put(self, key: bytes, text: str):
+        """Store text for key; database errors are logged, never raised."""
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO transcripts(h, text, created) VALUES (?, ?, ?)", (key, text, now)
+                )
+                # Expire old entries and keep at most max_rows
+                self._conn.execute("DELETE FROM transcripts WHERE created<?", (now - self.ttl_s,))
+                self._conn.execute(
+                    "DELETE FROM transcripts WHERE h IN "
+                    "(SELECT h FROM transcripts ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,),
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Cache write failed: {str(e)}")
+                self._conn.rollback()
+
 
 class MedASRTranscriber:
     """Wrapper for medical speech recognition using Google's MedASR model."""
 
-    def __init__(self, model_id: str = "google/medasr", device: Optional[str] = None):
+    def __init__(
+        self,
+        model_id: str = "google/medasr",
+        device: Optional[str] = None,
+        cache_path: Optional[str] = CACHE_PATH,
+    ):
         """
         Initialize the transcriber with Google's MedASR model.
 
@@ -28,13 +121,28 @@ class MedASRTranscriber:
         Args:
             model_id: HuggingFace model identifier
             device: Device to run on ('cuda', 'mps', 'cpu', or None for auto)
+            cache_path: SQLite file for caching results by audio content
+                (empty or None, the default, disables caching)
         """
         self.model_id = model_id
         self.device = self._get_device(device)
+
+        # How the model runs; also part of the cache key since each setting
+        # can change the transcript
+        self.quantize = self.device == "cpu" and os.getenv("MEDASR_QUANTIZE", "1") != "0"
+        self.compile = self.device == "cuda" and os.getenv("MEDASR_COMPILE") == "1"
+        self.autocast_dtype = torch.float16 if self.device == "cuda" else None
         self.processor = None
         self.model = None
+        self.cache = TranscriptionCache(cache_path) if cache_path else None
         self._loaded = False
 
+        # Reusable pinned host buffers for CUDA input transfers, per input name
+        # (only with MEDASR_PIN_MEMORY=1)
+        self._pinned = {}
+        self._pinned_lock = threading.Lock()
+        self._pinned_event = None
+
     def _get_device(self, device: Optional[str]) -> str:
         """Determine the best available device."""
         if device:
@@ -57,33 +165,166 @@ class MedASRTranscriber:
         self.model.to(self.device)
         self.model.eval()
 
+        # On CPU, quantize Linear layers to int8 (dynamic activations).
+        # Set MEDASR_QUANTIZE=0 to keep full FP32 weights.
+        if self.quantize:
+            logger.info("Applying int8 dynamic quantization for CPU inference")
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+        # Optionally fuse the Conformer kernels with Inductor. Off by default
+        # because it needs Triton (unavailable on Windows) and recompiles as
+        # input lengths vary.
+        if self.compile:
+            logger.info("Compiling model with torch.compile")
+            self.model = torch.compile(self.model, dynamic=True)
+
+        if self.device == "cuda" and PIN_MEMORY:
+            self._pinned_event = torch.cuda.Event()
+
         self._loaded = True
         logger.info("MedASR model loaded successfully")
 
-    def transcribe(self, audio_path: str) -> str:
+    def _forward(self, audios: List[np.ndarray]) -> torch.Tensor:
+        """Run the processor and model on a batch of 16kHz audio and return CTC logits."""
+        # Process audio with MedASR processor (pads to the longest clip)
+        inputs = self.processor(
+            audios,
+            sampling_rate=16000,
+            return_tensors="pt",
+            padding=True
+        )
+
+        # Move inputs to device
+        inputs = self._to_device(inputs)
+
+        # Run forward pass to get logits (CTC model), in half precision on CUDA.
+        # Other devices skip autocast entirely: older torch rejects MPS there
+        # even with enabled=False.
+        autocast = (
+            torch.autocast("cuda", dtype=self.autocast_dtype)
+            if self.autocast_dtype is not None
+            else contextlib.nullcontext()
+        )
+        with torch.inference_mode(), autocast:
+            return self.model(**inputs).logits
+
+    def _to_device(self, inputs) -> dict:
         """
-        Transcribe an audio file to text using MedASR.
+        Move processor outputs to the model's device.
 
-        Args:
-            audio_path: Path to the audio file (WAV, M4A, MP3, etc.)
+        With MEDASR_PIN_MEMORY=1 on CUDA, tensors up to PIN_MAX_BYTES are
+        staged through reusable pinned host buffers so the host-to-device
+        copy is asynchronous and can overlap queued kernels.
+        """
+        nbytes = sum(v.numel() * v.element_size() for v in inputs.values())
+        if self._pinned_event is None or nbytes > PIN_MAX_BYTES:
+            return {k: v.to(self.device) for k, v in inputs.items()}
 
-        Returns:
-            Transcribed text string
+        with self._pinned_lock:
+            # Don't overwrite the buffers until the previous copy out of them is done
+            self._pinned_event.synchronize()
+
+            moved = {}
+            for k, v in inputs.items():
+                buf = self._pinned.get(k)
+                if buf is None or buf.dtype != v.dtype or buf.numel() < v.numel():
+                    buf = torch.empty(v.numel(), dtype=v.dtype, pin_memory=True)
+                    self._pinned[k] = buf
+
+                staged = buf[:v.numel()].view(v.shape)
+                staged.copy_(v)
+                moved[k] = staged.to(self.device, non_blocking=True)
+
+            self._pinned_event.record()
+
+        return moved
+
+    def _predict_ids(self, audios: List[np.ndarray]) -> List[torch.Tensor]:
+        """
+        Get greedy per-frame token IDs for each clip in a batch.
+
+        Frames covering another clip's padding are trimmed off, assuming
+        output frames map linearly onto input samples.
+        """
+        # Stays on the model's device; only collapsed IDs are copied back
+        predicted_ids = self._forward(audios).argmax(dim=-1)
+
+        num_frames = predicted_ids.shape[1]
+        max_len = max(len(a) for a in audios)
+        return [
+            ids[:math.ceil(num_frames * len(a) / max_len)]
+            for ids, a in zip(predicted_ids, audios)
+        ]
+
+    def _decode_ids(self, ids: torch.Tensor) -> str:
+        """Collapse greedy CTC frame IDs and decode them to clean text."""
+        # CTC decoding: collapse repeated tokens and remove blanks
+        # Get the blank token ID (usually 0 for CTC models)
+        blank_id = self.processor.tokenizer.pad_token_id or 0
+
+        # CTC collapse in one vectorized pass on the device: keep the first
+        # frame of each run of identical tokens, then drop blanks. Only the
+        # short collapsed sequence is copied to the host.
+        keep = torch.empty_like(ids, dtype=torch.bool)
+        keep[0] = True
+        keep[1:] = ids[1:] != ids[:-1]
+        keep &= ids != blank_id
+        collapsed_ids = ids[keep].cpu().tolist()
+
+        # Decode the collapsed tokens
+        text = self.processor.tokenizer.decode(collapsed_ids, skip_special_tokens=True)
+        text = text.strip()
+
+        # Clean up any remaining artifacts
+        text = _TAG_RE.sub('', text)  # Remove any XML-like tags
+        text = _WS_RE.sub(' ', text)  # Collapse multiple spaces
+        return text.strip()
+
+    def warmup(self):
+        """
+        Run a dummy forward pass so kernel selection and lazy initialization
+        happen before the first real request.
         """
         if not self._loaded:
             self.load_model()
 
-        logger.info(f"Transcribing: {audio_path}")
+        logger.info("Warming up MedASR model...")
+        self._forward([np.zeros(16000, dtype=np.float32)])
+        logger.info("Warm-up complete")
 
-        # Load and resample audio to 16kHz (required by MedASR)
-        audio, sr = librosa.load(audio_path, sr=16000, mono=True)
+    def _resample(self, audio: np.ndarray, sr: int) -> np.ndarray:
+        """Resample audio to 16kHz (required by MedASR)."""
+        if sr == 16000:
+            return audio
+        return soxr.resample(audio, sr, 16000, quality="HQ")
+
+    def prepare_audio(self, audio: np.ndarray, sr: int, log_level: int = logging.INFO) -> np.ndarray:
+        """
+        Resample decoded audio to 16kHz and check it is usable.
+
+        Args:
+            audio: Mono audio samples as a float32 numpy array
+            sr: Sample rate of the audio
+            log_level: Level for the duration/amplitude log lines
+
+        Returns:
+            16kHz float32 samples ready for transcribe_batch
+
+        Raises:
+            ValueError: If the audio is empty, too short or silent
+        """
+        # Resample to 16kHz (required by MedASR)
+        audio = self._resample(audio, sr)
+        sr = 16000
 
         # Ensure audio is float32 numpy array
-        audio = audio.astype(np.float32)
+        audio = audio.astype(np.float32, copy=False)
 
         # Check for empty or too short audio
         duration = len(audio) / sr
-        logger.info(f"Audio duration: {duration:.2f}s, samples: {len(audio)}")
+        logger.log(log_level, f"Audio duration: {duration:.2f}s, samples: {len(audio)}")
 
         if len(audio) == 0:
             raise ValueError("Audio file is empty. Please record some audio before transcribing.")
@@ -91,65 +332,111 @@ class MedASRTranscriber:
         if duration < 0.1:
             raise ValueError(f"Audio too short ({duration:.2f}s). Please record at least 0.5 seconds of audio.")
 
-        # Check if audio is silent
-        max_amplitude = np.max(np.abs(audio))
-        logger.info(f"Max amplitude: {max_amplitude}")
+        # Check if audio is silent. Peak amplitude from max/min reductions
+        # avoids allocating an abs() copy of the whole clip.
+        max_amplitude = max(float(audio.max()), -float(audio.min()))
+        logger.log(log_level, f"Max amplitude: {max_amplitude}")
 
         if max_amplitude < 0.001:
             raise ValueError("Audio appears to be silent.")
 
-        # Process audio with MedASR processor
-        inputs = self.processor(
-            audio,
-            sampling_rate=16000,
-            return_tensors="pt",
-            padding=True
+        return audio
+
+    def _cache_key(self, audio: np.ndarray) -> bytes:
+        config = (
+            f"{self.model_id}|{self.device}|{self.autocast_dtype or torch.float32}"
+            f"|quantize={self.quantize}|compile={self.compile}"
         )
+        return TranscriptionCache.key(audio, config)
 
-        # Move inputs to device
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+    def lookup_cache(self, audio: np.ndarray) -> Optional[str]:
+        """
+        Return the cached transcript for 16kHz audio, if any.
 
-        # Run forward pass to get logits (CTC model)
-        with torch.no_grad():
-            logits = self.model(**inputs).logits
+        Args:
+            audio: 16kHz float32 samples, as returned by prepare_audio
 
-        # Get predicted token IDs using argmax
-        predicted_ids = torch.argmax(logits, dim=-1)
+        Returns:
+            Cached text, or None on a miss or when caching is disabled
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get(self._cache_key(audio))
 
-        # CTC decoding: collapse repeated tokens and remove blanks
-        # Get the blank token ID (usually 0 for CTC models)
-        blank_id = self.processor.tokenizer.pad_token_id or 0
+    def transcribe_batch(self, audios: List[np.ndarray], use_cache: Optional[List[bool]] = None) -> List[str]:
+        """
+        Transcribe several clips in a single forward pass.
 
-        # Manual CTC collapse: remove consecutive duplicates and blanks
-        collapsed_ids = []
-        prev_id = None
-        for token_id in predicted_ids[0].tolist():
-            if token_id != blank_id and token_id != prev_id:
-                collapsed_ids.append(token_id)
-            prev_id = token_id
+        The cache is not consulted here; check lookup_cache first.
 
-        # Decode the collapsed tokens
-        text = self.processor.tokenizer.decode(collapsed_ids, skip_special_tokens=True)
-        text = text.strip()
+        Args:
+            audios: 16kHz float32 clips, as returned by prepare_audio
+            use_cache: Per-clip flags for whether to store the result in the
+                cache (None stores every clip)
 
-        # Clean up any remaining artifacts
-        import re
-        text = re.sub(r'<[^>]+>', '', text)  # Remove any XML-like tags
-        text = re.sub(r'\s+', ' ', text)  # Collapse multiple spaces
-        text = text.strip()
+        Returns:
+            Transcribed text for each clip, in order
+        """
+        if not self._loaded:
+            self.load_model()
 
-        logger.info(f"Transcription complete: {len(text)} characters")
+        if use_cache is None:
+            use_cache = [True] * len(audios)
 
-        return text
+        logger.info(f"Transcribing batch of {len(audios)} clip(s)")
+
+        texts = [self._decode_ids(ids) for ids in self._predict_ids(audios)]
+
+        if self.cache is not None:
+            for audio, text, store in zip(audios, texts, use_cache):
+                if store:
+                    self.cache.put(self._cache_key(audio), text)
+
+        logger.info(f"Transcription complete: {sum(len(t) for t in texts)} characters")
+
+        return texts
 
-    def transcribe_chunks(self, audio_path: str, chunk_length_s: int = 20, stride_length_s: int = 2) -> str:
+    def transcribe(self, audio: np.ndarray, sr: int) -> str:
         """
-        Transcribe longer audio files in chunks.
+        Transcribe decoded audio to text using MedASR.
 
         Args:
-            audio_path: Path to the audio file
+            audio: Mono audio samples as a float32 numpy array
+            sr: Sample rate of the audio
+
+        Returns:
+            Transcribed text string
+        """
+        logger.info(f"Transcribing {len(audio)} samples at {sr}Hz")
+
+        audio = self.prepare_audio(audio, sr)
+
+        cached = self.lookup_cache(audio)
+        if cached is not None:
+            return cached
+        return self.transcribe_batch([audio])[0]
+
+    def transcribe_chunks(
+        self,
+        audio: np.ndarray,
+        sr: int,
+        chunk_length_s: int = 20,
+        stride_length_s: int = 2,
+        batch_size: int = 8,
+    ) -> str:
+        """
+        Transcribe longer audio in overlapping chunks.
+
+        Chunks are run through the model in batches; the overlapping stride
+        frames are dropped from each side before the CTC outputs are stitched
+        and collapsed as one sequence.
+
+        Args:
+            audio: Mono audio samples as a float32 numpy array
+            sr: Sample rate of the audio
             chunk_length_s: Length of each chunk in seconds
             stride_length_s: Overlap between chunks in seconds
+            batch_size: Number of chunks per forward pass
 
         Returns:
             Full transcribed text
@@ -157,30 +444,39 @@ class MedASRTranscriber:
         if not self._loaded:
             self.load_model()
 
-        logger.info(f"Transcribing in chunks: {audio_path}")
+        logger.info(f"Transcribing in chunks: {len(audio)} samples at {sr}Hz")
 
-        # For chunked transcription, use the pipeline
-        from transformers import pipeline
+        audio = self.prepare_audio(audio, sr)
 
-        pipe = pipeline(
-            "automatic-speech-recognition",
-            model=self.model,
-            tokenizer=self.processor,
-            feature_extractor=self.processor.feature_extractor,
-            device=self.device if self.device != "mps" else "cpu",
-        )
+        chunk_samples = chunk_length_s * 16000
+        stride_samples = stride_length_s * 16000
+        step = chunk_samples - 2 * stride_samples
+        if step <= 0:
+            raise ValueError("chunk_length_s must be more than twice stride_length_s")
 
-        # Load audio
-        audio, sr = librosa.load(audio_path, sr=16000, mono=True)
+        # Slice overlapping windows as views; the last one ends at the end of audio
+        windows = []
+        for start in range(0, len(audio), step):
+            end = min(start + chunk_samples, len(audio))
+            windows.append(audio[start:end])
+            if end == len(audio):
+                break
 
-        result = pipe(
-            audio,
-            chunk_length_s=chunk_length_s,
-            stride_length_s=stride_length_s
-        )
+        # Predict frame IDs for every window, a batch at a time
+        window_ids = []
+        for i in range(0, len(windows), batch_size):
+            window_ids.extend(self._predict_ids(windows[i:i + batch_size]))
+
+        # Drop stride frames on the overlapping sides and stitch
+        pieces = []
+        for i, (window, ids) in enumerate(zip(windows, window_ids)):
+            stride_frames = round(stride_samples * len(ids) / len(window))
+            left = stride_frames if i > 0 else 0
+            right = len(ids) - stride_frames if i < len(windows) - 1 else len(ids)
+            pieces.append(ids[left:right])
 
-        text = result.get("text", "").strip()
-        logger.info(f"Chunked transcription complete: {len(text)} characters")
+        text = self._decode_ids(torch.cat(pieces))
+        logger.info(f"Chunked transcription complete: {len(windows)} chunk(s), {len(text)} characters")
 
         return text
 
@@ -197,15 +493,16 @@ def get_transcriber() -> MedASRTranscriber:
     return _transcriber
 
 
-def transcribe_audio(audio_path: str) -> str:
+def transcribe_audio(audio: np.ndarray, sr: int) -> str:
     """
-    Convenience function to transcribe an audio file.
+    Convenience function to transcribe decoded audio.
 
     Args:
-        audio_path: Path to the audio file
+        audio: Mono audio samples as a float32 numpy array
+        sr: Sample rate of the audio
 
     Returns:
         Transcribed text
     """
     transcriber = get_transcriber()
-    return transcriber.transcribe(audio_path)
+    return transcriber.transcribe(audio, sr)